@@ -10,6 +10,9 @@ import csv
 NUM_BRANCHES = 10
 NUM_MODELS = 11
 ENDRANGE = 12
+PATH_COARSE_TOLERANCE = 10.0 # mm, shown immediately
+PATH_FINE_TOLERANCE = 1.0 # mm, refined path replaces the coarse one
+TRIAL_NODE_ATTRIBUTE = 'VesselHarvestingTutor.TrialNode' # set on nodes that only live for one trial
 
 #
 # VesselHarvestingTutor
@@ -155,16 +158,13 @@ class VesselHarvestingTutorWidget(ScriptedLoadableModuleWidget):
     logic.loadTransforms()
     logic.loadModels()
     logic.resetModels()
+    # path data left over from an earlier session must not end up in the trial snapshot
+    logic.removeTrialNodes()
+    logic.captureTrialState()
 
 
   def onResetTutorButton(self):
-      logic.resetMetrics()
-      logic.resetModels()
-      
-      # delete the path 
-      pathModel = slicer.util.getNode('Path Trajectory')
-      if pathModel: 
-        slicer.mrmlScene.RemoveNode(pathModel)
+      logic.restoreTrialState()
 
 
   def onRunTutorButton(self):
@@ -246,23 +246,30 @@ class VesselHarvestingTutorWidget(ScriptedLoadableModuleWidget):
 
 
   def onShowPathButton(self):
+    if logic.isPathUpToDate(PATH_FINE_TOLERANCE):
+      print 'Retractor trajectory unchanged, reusing reconstruction'
+      return
     print 'Reconstructing retractor trajectory ...'
-    fidNode = slicer.util.getNode('MarkupsFiducial_*')
-    if fidNode == None:
-      slicer.util.CreateNodeByClass('vtkMRMLMarkupsFiducialNode')
-      fidNode = slicer.util.getNode('MarkupsFiducial_*')
-    outputModel = slicer.mrmlScene.AddNode(slicer.vtkMRMLModelNode())
-    outputModel.SetName('Path Trajectory')
-    outputModel.CreateDefaultDisplayNodes()
-    outputModel.GetDisplayNode().SetSliceIntersectionVisibility(True)
-    outputModel.GetDisplayNode().SetColor(1,1,0)
-
-    markupsToModel = slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsToModelNode())
-    markupsToModel.SetAutoUpdateOutput(True)
-    markupsToModel.SetAndObserveModelNodeID(outputModel.GetID())
-    markupsToModel.SetAndObserveMarkupsNodeID(fidNode.GetID())
-    markupsToModel.SetModelType(slicer.vtkMRMLMarkupsToModelNode.Curve)
-    markupsToModel.SetCurveType(slicer.vtkMRMLMarkupsToModelNode.CardinalSpline)
+    # show a coarse path right away, then refine it once it has been rendered
+    # button stays disabled until the refined path is done, processEvents would let a second click in
+    self.showPathButton.enabled = False
+    try:
+      logic.reconstructPath(PATH_COARSE_TOLERANCE)
+      slicer.app.processEvents()
+      layoutManager = slicer.app.layoutManager()
+      if layoutManager and layoutManager.threeDViewCount > 0:
+        layoutManager.threeDWidget(0).threeDView().forceRender()
+    except:
+      self.showPathButton.enabled = True
+      raise
+    qt.QTimer.singleShot(0, self.onRefinePath)
+
+
+  def onRefinePath(self):
+    try:
+      logic.reconstructPath(PATH_FINE_TOLERANCE)
+    finally:
+      self.showPathButton.enabled = True
     print 'Reconstruction complete'
 
   
@@ -290,6 +297,8 @@ class VesselHarvestingTutorLogic(ScriptedLoadableModuleLogic):
   def __init__(self):
     self.resetMetrics()
     self.branchStarts = []
+    self.pathKey = None # (number of path points, tolerance) of the current path model
+    self.trialState = None
 
 
   def resetModels(self):
@@ -312,9 +321,88 @@ class VesselHarvestingTutorLogic(ScriptedLoadableModuleLogic):
     self.path = []
     self.lastTimestamp = time.time()
     self.runTutor = False    
-    # remove existing fiducials
-    fidNode = slicer.util.getNode('MarkupsFiducial_*')
-    slicer.mrmlScene.RemoveNode(fidNode)
+
+
+  def captureTrialState(self):
+    # snapshot of the scene at the start of a trial, restored by restoreTrialState
+    visibility = []
+    for i in range(NUM_MODELS):
+      branchNode = slicer.util.getNode('Model_' + str(i))
+      if branchNode:
+        displayNode = branchNode.GetDisplayNode()
+        visibility.append((displayNode, displayNode.GetVisibility()))
+
+    # control points of the branch lists and the cutter tip list
+    markups = []
+    for name in ['Points_' + str(i) for i in range(NUM_MODELS)] + ['F']:
+      fidNode = slicer.util.getNode(name)
+      if fidNode:
+        labels = [fidNode.GetNthFiducialLabel(n) for n in range(fidNode.GetNumberOfFiducials())]
+        markups.append({'node': fidNode, 'positions': self.getFiducialPositions(fidNode), 'labels': labels})
+
+    self.trialState = {
+      'visibility': visibility,
+      'markups': markups
+    }
+
+
+  def restoreTrialState(self):
+    self.resetMetrics()
+    self.pathKey = None
+    if self.trialState == None:
+      logging.warning('No trial state captured, resetting node by node')
+      self.resetModels()
+      self.removeTrialNodes()
+      return
+
+    scene = slicer.mrmlScene
+    scene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      self.removeTrialNodes()
+
+      for displayNode, visible in self.trialState['visibility']:
+        displayNode.SetVisibility(visible)
+
+      for markup in self.trialState['markups']:
+        fidNode = markup['node']
+        if self.getFiducialPositions(fidNode) == markup['positions']:
+          continue
+        wasModifying = fidNode.StartModify()
+        for n in range(fidNode.GetNumberOfFiducials() - 1, len(markup['positions']) - 1, -1):
+          fidNode.RemoveMarkup(n)
+        for n, position in enumerate(markup['positions']):
+          if n < fidNode.GetNumberOfFiducials():
+            fidNode.SetNthFiducialPositionFromArray(n, position)
+          else:
+            fidNode.AddFiducialFromArray(position, markup['labels'][n])
+        fidNode.EndModify(wasModifying)
+    finally:
+      scene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+
+  def getFiducialPositions(self, fidNode):
+    positions = []
+    for n in range(fidNode.GetNumberOfFiducials()):
+      position = [0,0,0]
+      fidNode.GetNthFiducialPosition(n, position)
+      positions.append(position)
+    return positions
+
+
+  def removeTrialNodes(self):
+    # only nodes this module tagged as trial nodes, data the user loaded is left alone
+    trialNodes = []
+    for className in ['vtkMRMLMarkupsToModelNode', 'vtkMRMLModelNode', 'vtkMRMLMarkupsFiducialNode']:
+      for node in slicer.util.getNodesByClass(className):
+        if node.GetAttribute(TRIAL_NODE_ATTRIBUTE):
+          trialNodes.append(node)
+    for node in trialNodes:
+      if node.IsA('vtkMRMLDisplayableNode'):
+        for n in range(node.GetNumberOfDisplayNodes()):
+          slicer.mrmlScene.RemoveNode(node.GetNthDisplayNode(n))
+        if node.GetStorageNode():
+          slicer.mrmlScene.RemoveNode(node.GetStorageNode())
+      slicer.mrmlScene.RemoveNode(node)
 
 
   def loadTransforms(self):
@@ -549,21 +637,7 @@ class VesselHarvestingTutorLogic(ScriptedLoadableModuleLogic):
       cutterTipWorld = [0,0,0,0]
       fiducial = slicer.util.getNode("F")
       fiducial.GetNthFiducialWorldCoordinates(0,cutterTipWorld) # z coordinate not important for linear slope calculation
-
-      # add path fiducials to separate node
-      self.pathFiducialsNode = slicer.util.getNode('MarkupsFiducial_*')
-      if self.pathFiducialsNode == None:
-        self.pathFiducialsNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLMarkupsFiducialNode')
-        slicer.mrmlScene.AddNode(self.pathFiducialsNode)
-      slicer.modules.markups.logic().AddFiducial(cutterTipWorld[0], cutterTipWorld[1], cutterTipWorld[2])
-      # set new fiducial's label and hide from 3D view
-      n = self.pathFiducialsNode.GetNumberOfFiducials() - 1
-      self.pathFiducialsNode.SetNthFiducialLabel(n, str(n))
-      self.pathFiducialsNode.SetNthFiducialVisibility(n, 0)  
-
-      self.pathFiducialsX.append(cutterTipWorld[0])
-      self.pathFiducialsY.append(cutterTipWorld[1])
-      self.path.append(cutterTipWorld[:-1])
+      self.addPathPoint(cutterTipWorld)
       self.lastTimestamp = time.time()
 
       self.updateAngleMetrics()
@@ -572,6 +646,26 @@ class VesselHarvestingTutorLogic(ScriptedLoadableModuleLogic):
         self.updateDistanceMetrics()
 
 
+  def addPathPoint(self, cutterTipWorld):
+    # add path fiducials to separate node
+    self.pathFiducialsNode = slicer.util.getNode('MarkupsFiducial_*')
+    if self.pathFiducialsNode == None:
+      self.pathFiducialsNode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLMarkupsFiducialNode')
+      self.pathFiducialsNode.SetName('MarkupsFiducial_Path')
+      self.pathFiducialsNode.SetAttribute(TRIAL_NODE_ATTRIBUTE, 'true')
+      slicer.mrmlScene.AddNode(self.pathFiducialsNode)
+    # add to the path list directly, the active markups list may be another list (e.g. Path Trajectory Points)
+    self.pathFiducialsNode.AddFiducial(cutterTipWorld[0], cutterTipWorld[1], cutterTipWorld[2])
+    # set new fiducial's label and hide from 3D view
+    n = self.pathFiducialsNode.GetNumberOfFiducials() - 1
+    self.pathFiducialsNode.SetNthFiducialLabel(n, str(n))
+    self.pathFiducialsNode.SetNthFiducialVisibility(n, 0)
+
+    self.pathFiducialsX.append(cutterTipWorld[0])
+    self.pathFiducialsY.append(cutterTipWorld[1])
+    self.path.append(cutterTipWorld[:-1])
+
+
   def checkModel(self): # check if vessel branch needs to be snipped
     minDistance = float("inf")
     index = 0
@@ -652,6 +746,84 @@ class VesselHarvestingTutorLogic(ScriptedLoadableModuleLogic):
     return self.metrics
 
 
+  def simplifyTrajectory(self, points, tolerance):
+    # Ramer-Douglas-Peucker, iterative; distances of all points in a span to its chord are computed at once
+    points = numpy.asarray(points, dtype=float)
+    numPoints = len(points)
+    if numPoints < 3:
+      return points
+    keep = numpy.zeros(numPoints, dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+    spans = [(0, numPoints - 1)]
+    while spans:
+      first, last = spans.pop()
+      if last - first < 2:
+        continue
+      chord = points[last] - points[first]
+      offsets = points[first + 1:last] - points[first]
+      chordLength = numpy.linalg.norm(chord)
+      if chordLength > 0:
+        distances = numpy.linalg.norm(numpy.cross(offsets, chord), axis=1) / chordLength
+      else: # closed span, use distance to the shared end point
+        distances = numpy.linalg.norm(offsets, axis=1)
+      index = numpy.argmax(distances)
+      if distances[index] > tolerance:
+        split = first + 1 + index
+        keep[split] = True
+        spans.append((first, split))
+        spans.append((split, last))
+    return points[keep]
+
+
+  def isPathUpToDate(self, tolerance):
+    return self.pathKey == (len(self.path), tolerance) and slicer.util.getNode('Path Trajectory') != None
+
+
+  def reconstructPath(self, tolerance):
+    if self.isPathUpToDate(tolerance):
+      return
+
+    pathPoints = slicer.util.getNode('Path Trajectory Points')
+    if pathPoints == None:
+      pathPoints = slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsFiducialNode())
+      pathPoints.SetName('Path Trajectory Points')
+      pathPoints.SetAttribute(TRIAL_NODE_ATTRIBUTE, 'true')
+      pathPoints.CreateDefaultDisplayNodes()
+      pathPoints.GetDisplayNode().SetVisibility(False)
+
+    outputModel = slicer.util.getNode('Path Trajectory')
+    if outputModel == None:
+      outputModel = slicer.mrmlScene.AddNode(slicer.vtkMRMLModelNode())
+      outputModel.SetName('Path Trajectory')
+      outputModel.SetAttribute(TRIAL_NODE_ATTRIBUTE, 'true')
+      outputModel.CreateDefaultDisplayNodes()
+      outputModel.GetDisplayNode().SetSliceIntersectionVisibility(True)
+      outputModel.GetDisplayNode().SetColor(1,1,0)
+
+    markupsToModel = slicer.util.getNode('Path Trajectory MarkupsToModel')
+    if markupsToModel == None:
+      markupsToModel = slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsToModelNode())
+      markupsToModel.SetName('Path Trajectory MarkupsToModel')
+      markupsToModel.SetAttribute(TRIAL_NODE_ATTRIBUTE, 'true')
+      markupsToModel.SetModelType(slicer.vtkMRMLMarkupsToModelNode.Curve)
+      markupsToModel.SetCurveType(slicer.vtkMRMLMarkupsToModelNode.CardinalSpline)
+      markupsToModel.SetAutoUpdateOutput(True)
+    markupsToModel.SetAndObserveModelNodeID(outputModel.GetID())
+    markupsToModel.SetAndObserveMarkupsNodeID(pathPoints.GetID())
+
+    # replace control points in one batch so the spline is only fitted once
+    simplified = self.simplifyTrajectory(self.path, tolerance)
+    wasModifying = pathPoints.StartModify()
+    pathPoints.RemoveAllMarkups()
+    for point in simplified:
+      pathPoints.AddFiducial(point[0], point[1], point[2])
+    pathPoints.EndModify(wasModifying)
+
+    self.pathKey = (len(self.path), tolerance)
+    logging.info('Path trajectory: ' + str(len(simplified)) + ' of ' + str(len(self.path)) + ' points kept')
+
+
   def getTimestamp(self, start, stop):
     elapsed = stop - start 
     formattedTime = time.strftime('%H:%M:%S', time.gmtime(elapsed)) # convert seconds to HH:MM:SS timestamp
@@ -667,9 +839,15 @@ class VesselHarvestingTutorTest(ScriptedLoadableModuleTest):
 
   def runTest(self):
     """Run as few or as many tests as needed here.
+    For the 100-trial reset benchmark call test_TrialReset(numberOfTrials=100).
     """
     self.setUp()
     self.test_VesselHarvestingTutor1()
+    self.test_SimplifyTrajectory()
+    self.setUp()
+    self.test_ReconstructPath()
+    self.setUp()
+    self.test_TrialReset()
 
 
   def setUp(self):
@@ -678,8 +856,97 @@ class VesselHarvestingTutorTest(ScriptedLoadableModuleTest):
     slicer.mrmlScene.Clear(0)
 
 
+  def setUpTutorScene(self):
+    # nodes loadTransforms expects to find in the scene
+    cutterTip = slicer.util.getNode('F')
+    if cutterTip == None:
+      cutterTip = slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsFiducialNode())
+      cutterTip.SetName('F')
+      cutterTip.CreateDefaultDisplayNodes()
+      cutterTip.AddFiducial(0, 0, 0)
+    if slicer.util.getNode('Default Scene Camera') == None:
+      camera = slicer.mrmlScene.AddNode(slicer.vtkMRMLCameraNode())
+      camera.SetName('Default Scene Camera')
+
+
   def test_VesselHarvestingTutor1(self):
+    self.setUpTutorScene()
     logic = VesselHarvestingTutorLogic()
     logic.loadTransforms()
     logic.loadModels()
 
+
+  def test_SimplifyTrajectory(self):
+    logic = VesselHarvestingTutorLogic()
+    straight = [[i, 2 * i, 0] for i in range(100)]
+    self.assertEqual(len(logic.simplifyTrajectory(straight, 0.1)), 2)
+
+    zigzag = [[i, 10 * (i % 2), 0] for i in range(20)]
+    self.assertEqual(len(logic.simplifyTrajectory(zigzag, 1.0)), 20)
+    self.assertEqual(len(logic.simplifyTrajectory(zigzag, 20.0)), 2)
+
+
+  def test_ReconstructPath(self):
+    logic = VesselHarvestingTutorLogic()
+    logic.path = [[i, 0.1 * i * i, 0] for i in range(200)]
+    logic.reconstructPath(PATH_COARSE_TOLERANCE)
+    pathModel = slicer.util.getNode('Path Trajectory')
+    pathPoints = slicer.util.getNode('Path Trajectory Points')
+    self.assertLess(pathPoints.GetNumberOfFiducials(), len(logic.path))
+
+    # unchanged path is not reconstructed again
+    pathKey = logic.pathKey
+    pointsMTime = pathPoints.GetMTime()
+    logic.reconstructPath(PATH_COARSE_TOLERANCE)
+    self.assertEqual(slicer.util.getNode('Path Trajectory').GetID(), pathModel.GetID())
+    self.assertEqual(pathPoints.GetMTime(), pointsMTime)
+    self.assertEqual(logic.pathKey, pathKey)
+
+    # new points rebuild the path into the same model
+    logic.path.append([200, 0, 0])
+    logic.reconstructPath(PATH_COARSE_TOLERANCE)
+    self.assertNotEqual(logic.pathKey, pathKey)
+    self.assertEqual(slicer.util.getNode('Path Trajectory').GetID(), pathModel.GetID())
+
+
+  def test_TrialReset(self, numberOfTrials=10):
+    self.setUpTutorScene()
+    logic = VesselHarvestingTutorLogic()
+    logic.loadTransforms()
+    logic.loadModels()
+    logic.resetModels()
+    logic.captureTrialState()
+
+    # data loaded by the user must survive trial resets
+    userModel = slicer.mrmlScene.AddNode(slicer.vtkMRMLModelNode())
+    userModel.SetName('User Model')
+    numNodes = slicer.mrmlScene.GetNumberOfNodes()
+    branchPoints = slicer.util.getNode('Points_1')
+    branchPositions = logic.getFiducialPositions(branchPoints)
+
+    resetTimes = []
+    for trial in range(numberOfTrials):
+      # simulate a recorded trial: path fiducials, a snipped branch, edited branch geometry and a reconstructed path
+      for i in range(50):
+        logic.addPathPoint([i, 0.1 * i * i, 0, 1])
+      slicer.util.getNode('Model_' + str(trial % NUM_MODELS)).GetDisplayNode().SetVisibility(False)
+      branchPoints.SetNthFiducialPosition(0, trial, trial, trial)
+      logic.reconstructPath(PATH_FINE_TOLERANCE)
+
+      startTime = time.time()
+      logic.restoreTrialState()
+      resetTimes.append(time.time() - startTime)
+
+      self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), numNodes)
+      self.assertEqual(len(logic.path), 0)
+      self.assertEqual(logic.getFiducialPositions(branchPoints), branchPositions)
+      for i in range(NUM_MODELS):
+        self.assertTrue(slicer.util.getNode('Model_' + str(i)).GetDisplayNode().GetVisibility())
+    self.assertEqual(slicer.util.getNode('User Model').GetID(), userModel.GetID())
+
+    # timings are only logged, wall-clock bounds are unreliable on loaded machines
+    sampleSize = min(10, numberOfTrials)
+    firstTrials = sum(resetTimes[:sampleSize]) / sampleSize
+    lastTrials = sum(resetTimes[-sampleSize:]) / sampleSize
+    logging.info('Trial reset: first ' + str(sampleSize) + ' trials ' + str(round(firstTrials * 1000, 2)) + ' ms, last '
+      + str(sampleSize) + ' trials ' + str(round(lastTrials * 1000, 2)) + ' ms')